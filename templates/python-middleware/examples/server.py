@@ -1,22 +1,52 @@
 """FastAPI server example with APort middleware."""
 
 import os
-from typing import Dict, Any
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List
 from fastapi import FastAPI, Request, Depends, HTTPException
+from fastapi.middleware.gzip import GZipMiddleware
 from pydantic import BaseModel
-from aport_middleware import APortMiddleware, require_policy
+from aport_middleware import APortMiddleware, aclose_shared_middleware, require_policy
+
+# Initialize APort middleware
+aport_middleware = APortMiddleware(
+    api_key=os.getenv('APORT_API_KEY'),
+    base_url=os.getenv('APORT_BASE_URL')
+)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    """Close APort clients on shutdown, including the one behind require_policy()."""
+    try:
+        async with aport_middleware.lifespan(app):
+            yield
+    finally:
+        await aclose_shared_middleware()
 
 # Initialize FastAPI app
 app = FastAPI(
     title="APort FastAPI Example",
     description="Example FastAPI application with APort middleware",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
-# Initialize APort middleware
-aport_middleware = APortMiddleware(
-    api_key=os.getenv('APORT_API_KEY'),
-    base_url=os.getenv('APORT_BASE_URL')
+# Compress larger responses such as full passports; level 5 keeps most of
+# the size reduction of level 9 at a fraction of the CPU cost
+app.add_middleware(GZipMiddleware, minimum_size=1000, compresslevel=5)
+
+# Policy dependencies, built once at import and shared by every request
+require_refund_policy = aport_middleware.require_policy(
+    "finance.payment.refund.v1",
+    context={"endpoint": "refund", "action": "process_refund"}
+)
+require_admin_policy = aport_middleware.require_policy(
+    "admin.access",
+    context={"endpoint": "admin", "action": "view_dashboard"}
+)
+require_transfer_policy = require_policy(
+    "payments.transfer.v1",
+    context={"endpoint": "transfer", "action": "process_transfer"}
 )
 
 # Pydantic models
@@ -32,6 +62,21 @@ class RefundResponse(BaseModel):
     order_id: str
     agent_id: str
 
+class AdminUser(BaseModel):
+    agent_id: str
+    capabilities: List[str]
+    limits: Dict[str, Any]
+
+class AdminResponse(BaseModel):
+    message: str
+    user: AdminUser
+    timestamp: str
+
+class TransferResponse(BaseModel):
+    message: str
+    agent_id: str
+    verified: bool
+
 # Routes
 @app.get("/")
 async def root():
@@ -57,12 +102,7 @@ async def public_endpoint():
 @app.post("/refund", response_model=RefundResponse)
 async def process_refund(
     request: RefundRequest,
-    aport_data: Dict[str, Any] = Depends(
-        aport_middleware.require_policy(
-            "finance.payment.refund.v1",
-            context={"endpoint": "refund", "action": "process_refund"}
-        )
-    )
+    aport_data: Dict[str, Any] = Depends(require_refund_policy)
 ):
     """Process a refund with APort verification."""
     # Access verification result
@@ -70,13 +110,14 @@ async def process_refund(
     agent_id = aport_data['agent_id']
     
     # Check specific limits
-    if request.amount > passport.get('limits', {}).get('refund_amount_max_per_tx', 0):
+    max_refund = (passport.get('limits') or {}).get('refund_amount_max_per_tx', 0)
+    if request.amount > max_refund:
         raise HTTPException(
             status_code=403,
             detail={
                 "error": "Refund amount exceeds limit",
                 "requested": request.amount,
-                "limit": passport.get('limits', {}).get('refund_amount_max_per_tx')
+                "limit": max_refund
             }
         )
     
@@ -91,14 +132,9 @@ async def process_refund(
         agent_id=agent_id
     )
 
-@app.get("/admin")
+@app.get("/admin", response_model=AdminResponse)
 async def admin_dashboard(
-    aport_data: Dict[str, Any] = Depends(
-        aport_middleware.require_policy(
-            "admin.access",
-            context={"endpoint": "admin", "action": "view_dashboard"}
-        )
-    )
+    aport_data: Dict[str, Any] = Depends(require_admin_policy)
 ):
     """Admin dashboard with APort verification."""
     passport = aport_data['passport']
@@ -115,15 +151,10 @@ async def admin_dashboard(
     }
 
 # Alternative: Using the convenience function
-@app.post("/transfer")
+@app.post("/transfer", response_model=TransferResponse)
 async def transfer_funds(
     request: Request,
-    aport_data: Dict[str, Any] = Depends(
-        require_policy(
-            "payments.transfer.v1",
-            context={"endpoint": "transfer", "action": "process_transfer"}
-        )
-    )
+    aport_data: Dict[str, Any] = Depends(require_transfer_policy)
 ):
     """Transfer funds using the convenience function."""
     return {
@@ -134,4 +165,7 @@ async def transfer_funds(
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # With `pip install -e ".[server]"`, uvicorn's default "auto" settings
+    # pick uvloop for the event loop and httptools for HTTP parsing. uvloop
+    # is not available on Windows, where the asyncio loop is used instead.
+    uvicorn.run(app, host="0.0.0.0", port=8000, loop="auto", http="auto")
@@ -1,7 +1,21 @@
 """APort middleware for FastAPI applications."""
 
-from .middleware import APortMiddleware, require_policy
+from .middleware import (
+    APortASGIMiddleware,
+    APortMiddleware,
+    APortTimingMiddleware,
+    aclose_shared_middleware,
+    require_policy,
+)
 from .exceptions import APortError, VerificationError
 
 __version__ = "1.0.0"
-__all__ = ["APortMiddleware", "require_policy", "APortError", "VerificationError"]
+__all__ = [
+    "APortMiddleware",
+    "APortASGIMiddleware",
+    "APortTimingMiddleware",
+    "require_policy",
+    "aclose_shared_middleware",
+    "APortError",
+    "VerificationError",
+]
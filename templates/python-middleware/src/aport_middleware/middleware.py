@@ -1,26 +1,85 @@
 """APort middleware implementation for FastAPI."""
 
+import asyncio
+import copy
+import hashlib
+import json
+import logging
 import os
-from typing import Optional, Dict, Any, Callable
-from fastapi import Request, HTTPException, Depends
-from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from functools import cached_property
+from typing import Optional, Dict, Any, AsyncIterator, Callable, FrozenSet, Iterable, List, Set, Tuple
+from urllib.parse import parse_qsl
+from fastapi import FastAPI, Request, Response, HTTPException
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from .exceptions import APortError
 # from aporthq_sdk import APortClient  # Uncomment when package is available
-from .exceptions import APortError, VerificationError
+
+
+# Agent ID lookup order: headers first, then query string, then JSON body
+_AGENT_ID_HEADERS = ('x-agent-id', 'x-aport-agent-id')
+_AGENT_ID_QUERY_PARAM = 'agent_id'
+_AGENT_ID_BODY_KEYS = ('agent_id', 'agentId')
+
+# Raw ASGI header names, as they appear in scope['headers']
+_RAW_AGENT_ID_HEADERS = tuple(name.encode('latin-1') for name in _AGENT_ID_HEADERS)
+_RAW_USER_AGENT_HEADER = b'user-agent'
+
+# Static error payloads, built once instead of per rejected request
+_AGENT_ID_REQUIRED = {
+    'error': 'Agent ID required',
+    'message': 'Agent ID must be provided in headers, query, or body'
+}
+_VERIFICATION_ERROR = {
+    'error': 'Verification error',
+    'message': 'Internal verification error'
+}
+
+# Maximum number of cache entries refreshed at the same time
+_REFRESH_CONCURRENCY = 16
+
+# Methods for which a matching If-None-Match may short-circuit to 304
+_CONDITIONAL_METHODS = frozenset({'GET', 'HEAD'})
+
+# Structural context key: the context items with their value types, so that
+# e.g. '1', Decimal('1') and True do not share an entry
+_ContextKey = FrozenSet[Tuple[Any, type, Any]]
+
+# Verification cache key: (policy, agent ID, context key)
+_CacheKey = Tuple[str, str, _ContextKey]
+
+# One verification in a batch: (policy, agent ID, context)
+_BatchItem = Tuple[str, str, Optional[Dict[str, Any]]]
+
+logger = logging.getLogger(__name__)
 
 
 class MockAPortClient:
     """Mock APort Client for template demonstration.
     
     In production, replace with: from aporthq_sdk import APortClient
+    
+    A real client should reuse one pooled HTTP client for every call. Pass it
+    as ``http_client`` (e.g. an ``httpx.AsyncClient`` with HTTP/2 enabled);
+    the client takes ownership and closes it in ``aclose()``.
     """
     
-    def __init__(self, api_key: Optional[str] = None, base_url: Optional[str] = None, **kwargs):
+    def __init__(
+        self,
+        api_key: Optional[str] = None,
+        base_url: Optional[str] = None,
+        http_client: Optional[Any] = None,
+        **kwargs
+    ):
         self.api_key = api_key
         self.base_url = base_url or 'https://api.aport.io'
+        self.http_client = http_client
     
     async def verify(self, policy: str, agent_id: str, context: Optional[Dict[str, Any]] = None) -> 'MockVerificationResult':
         """Mock verification - always returns success for template."""
-        print(f"[MOCK] Verifying agent {agent_id} against policy {policy}")
+        logger.info("[MOCK] Verifying agent %s against policy %s", agent_id, policy)
         return MockVerificationResult(
             verified=True,
             passport={
@@ -31,17 +90,71 @@ class MockAPortClient:
             policy=policy,
             message="Mock verification successful"
         )
+    
+    async def verify_batch(self, items: List['_BatchItem']) -> List['MockVerificationResult']:
+        """Mock batch verification - returns one result per item, in order.
+        
+        Assumes the APort API offers a batch verification endpoint. A failed
+        item may be returned as an exception instance instead of a result.
+        """
+        return [
+            await self.verify(policy=policy, agent_id=agent_id, context=context)
+            for policy, agent_id, context in items
+        ]
+    
+    async def aclose(self) -> None:
+        """Close the underlying HTTP client, if one was provided."""
+        if self.http_client is not None:
+            await self.http_client.aclose()
 
 
 class MockVerificationResult:
-    """Mock verification result for template demonstration."""
+    """Mock verification result for template demonstration.
+    
+    Attributes cannot be reassigned once created, since one instance may be
+    cached and handed to many requests. The ``passport`` and ``details``
+    dicts themselves are not frozen; the middleware copies the passport
+    before handing it to a request.
+    """
+    
+    __slots__ = ('verified', 'passport', 'policy', 'message', 'details')
+    
+    verified: bool
+    passport: Dict[str, Any]
+    policy: str
+    message: str
+    details: Dict[str, Any]
     
     def __init__(self, verified: bool, passport: Dict[str, Any], policy: str, message: str, details: Optional[Dict[str, Any]] = None):
-        self.verified = verified
-        self.passport = passport
-        self.policy = policy
-        self.message = message
-        self.details = details or {}
+        # dataclass(frozen=True, slots=True) needs Python 3.10
+        set_field = object.__setattr__
+        set_field(self, 'verified', verified)
+        set_field(self, 'passport', passport)
+        set_field(self, 'policy', policy)
+        set_field(self, 'message', message)
+        set_field(self, 'details', details or {})
+    
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError(f"{type(self).__name__} is immutable")
+    
+    def __delattr__(self, name: str) -> None:
+        raise AttributeError(f"{type(self).__name__} is immutable")
+    
+    def __reduce__(self) -> Tuple[type, Tuple[Any, ...]]:
+        # Rebuild through __init__: the default slot restore uses setattr
+        return (type(self), (self.verified, self.passport, self.policy, self.message, self.details))
+
+
+class _CacheEntry:
+    """Cached verification result and what is needed to refresh it."""
+    
+    __slots__ = ('expires_at', 'result', 'context', 'last_used')
+    
+    def __init__(self, expires_at: float, result: MockVerificationResult, context: Optional[Dict[str, Any]]):
+        self.expires_at = expires_at
+        self.result = result
+        self.context = context
+        self.last_used = time.monotonic()
 
 
 class APortMiddleware:
@@ -51,6 +164,10 @@ class APortMiddleware:
         self,
         api_key: Optional[str] = None,
         base_url: Optional[str] = None,
+        cache_ttl: Optional[float] = None,
+        cache_size: int = 1024,
+        warm_refresh: bool = False,
+        batch_window_ms: float = 0,
         **kwargs
     ):
         """Initialize the APort middleware.
@@ -58,126 +175,414 @@ class APortMiddleware:
         Args:
             api_key: APort API key. If not provided, will use APORT_API_KEY env var.
             base_url: APort API base URL. If not provided, will use APORT_BASE_URL env var.
+            cache_ttl: Seconds to reuse a verification result for the same policy,
+                agent and context. If not provided, will use APORT_CACHE_TTL env
+                var (default 30). 0 disables caching.
+            cache_size: Maximum number of cached verification results
+            warm_refresh: Re-verify cached results that are still in use in the
+                background before they expire, so hot agents never wait on a
+                cache miss. Call ``aclose()`` on shutdown to stop the task.
+            batch_window_ms: Collect verifications for this many milliseconds
+                and send them in one ``verify_batch`` call. Requires a batch
+                verification endpoint on the APort API. 0 disables batching.
             **kwargs: Additional client options
         """
-        self.client = MockAPortClient(
-            api_key=api_key or os.getenv('APORT_API_KEY'),
-            base_url=base_url or os.getenv('APORT_BASE_URL', 'https://api.aport.io'),
+        self._client_options = {
+            'api_key': api_key or os.getenv('APORT_API_KEY'),
+            'base_url': base_url or os.getenv('APORT_BASE_URL', 'https://api.aport.io'),
             **kwargs
-        )
+        }
+        if cache_ttl is None:
+            cache_ttl = float(os.getenv('APORT_CACHE_TTL', '30'))
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self.warm_refresh = warm_refresh
+        self._cache: 'OrderedDict[_CacheKey, _CacheEntry]' = OrderedDict()
+        self._inflight: Dict[_CacheKey, 'asyncio.Future[MockVerificationResult]'] = {}
+        self._refresh_task: Optional['asyncio.Task[None]'] = None
+        self.batch_window = batch_window_ms / 1000
+        self._pending: List[Tuple[_BatchItem, 'asyncio.Future[MockVerificationResult]']] = []
+        self._batch_timer: Optional[asyncio.TimerHandle] = None
+        self._batch_tasks: Set['asyncio.Task[None]'] = set()
+        self._dependencies: Dict[Tuple[str, _ContextKey, bool, bool], Callable] = {}
+    
+    @cached_property
+    def client(self) -> MockAPortClient:
+        """APort client, created on first use rather than at import time."""
+        return MockAPortClient(**self._client_options)
+    
+    async def verify(
+        self,
+        policy: str,
+        agent_id: str,
+        context: Optional[Dict[str, Any]] = None
+    ) -> 'MockVerificationResult':
+        """Verify an agent against a policy, reusing recent results.
+        
+        Results are cached for ``cache_ttl`` seconds per (policy, agent ID,
+        context). Concurrent calls for the same key share a single client
+        request. Exceptions are never cached, and contexts with unhashable
+        values bypass the cache.
+        
+        Args:
+            policy: Policy pack identifier
+            agent_id: Agent ID to verify
+            context: Verification context
+            
+        Returns:
+            Verification result from the APort client
+        """
+        context_key = _context_key(context) if self.cache_ttl > 0 else None
+        if context_key is None:
+            return await self._call_client(policy, agent_id, context)
+        
+        key = (policy, agent_id, context_key)
+        entry = self._cache.get(key)
+        if entry is not None:
+            now = time.monotonic()
+            if entry.expires_at > now:
+                entry.last_used = now
+                self._cache.move_to_end(key)
+                return entry.result
+            del self._cache[key]
+        
+        # Shielded so one cancelled request does not cancel the shared call
+        return await asyncio.shield(self._shared_verification(key, policy, agent_id, context))
+    
+    def _shared_verification(
+        self,
+        key: '_CacheKey',
+        policy: str,
+        agent_id: str,
+        context: Optional[Dict[str, Any]]
+    ) -> 'asyncio.Future[MockVerificationResult]':
+        """Return the in-flight verification for a key, starting one if needed."""
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._verify_and_store(key, policy, agent_id, context))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return task
+    
+    async def _verify_and_store(
+        self,
+        key: '_CacheKey',
+        policy: str,
+        agent_id: str,
+        context: Optional[Dict[str, Any]]
+    ) -> 'MockVerificationResult':
+        """Call the client and cache its result."""
+        result = await self._call_client(policy, agent_id, context)
+        self._cache[key] = _CacheEntry(time.monotonic() + self.cache_ttl, result, context)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        if self.warm_refresh and self._refresh_task is None:
+            self._refresh_task = asyncio.ensure_future(self._refresh_loop())
+        return result
+    
+    async def _call_client(
+        self,
+        policy: str,
+        agent_id: str,
+        context: Optional[Dict[str, Any]]
+    ) -> 'MockVerificationResult':
+        """Verify with the client, batched with concurrent calls when enabled."""
+        if self.batch_window <= 0:
+            return await self.client.verify(policy=policy, agent_id=agent_id, context=context)
+        
+        # No await between reading and updating the pending list, so the
+        # event loop cannot interleave another verification here
+        loop = asyncio.get_running_loop()
+        future: 'asyncio.Future[MockVerificationResult]' = loop.create_future()
+        self._pending.append(((policy, agent_id, context), future))
+        if self._batch_timer is None:
+            self._batch_timer = loop.call_later(self.batch_window, self._flush_batch)
+        return await future
+    
+    def _flush_batch(self) -> None:
+        """Send every pending verification as one batch."""
+        self._batch_timer = None
+        batch, self._pending = self._pending, []
+        task = asyncio.ensure_future(self._run_batch(batch))
+        # Keep a reference until done so the task is not garbage collected
+        self._batch_tasks.add(task)
+        task.add_done_callback(self._batch_tasks.discard)
+    
+    async def _run_batch(
+        self,
+        batch: List[Tuple['_BatchItem', 'asyncio.Future[MockVerificationResult]']]
+    ) -> None:
+        """Call ``verify_batch`` and hand each caller its own result."""
+        try:
+            try:
+                results: List[Any] = await self.client.verify_batch([item for item, _ in batch])
+                if len(results) != len(batch):
+                    raise APortError(f"Batch verification returned {len(results)} results for {len(batch)} requests")
+            except Exception as error:
+                # A new exception per caller: raising one shared instance in
+                # several tasks would overwrite its traceback each time
+                for _, future in batch:
+                    if not future.done():
+                        batch_error = APortError(f"Batch verification failed: {error}")
+                        batch_error.__cause__ = error
+                        future.set_exception(batch_error)
+                return
+            for (_, future), result in zip(batch, results):
+                if future.done():  # caller was cancelled
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+        finally:
+            # If verify_batch was cancelled nothing above ran; never leave a
+            # caller waiting on a future that will not be resolved
+            for _, future in batch:
+                if not future.done():
+                    future.cancel()
+    
+    async def _refresh_loop(self) -> None:
+        """Periodically refresh cached results until cancelled."""
+        while True:
+            await asyncio.sleep(self.cache_ttl / 4)
+            await self._refresh_expiring()
+    
+    async def _refresh_expiring(self) -> None:
+        """Re-verify entries used within the last TTL that expire within half a TTL."""
+        now = time.monotonic()
+        expiring = [
+            (key, entry) for key, entry in self._cache.items()
+            if entry.expires_at - now < self.cache_ttl / 2
+            and now - entry.last_used < self.cache_ttl
+        ]
+        # Refresh concurrently so one slow verification does not hold up
+        # the others, but without flooding the API
+        limit = asyncio.Semaphore(_REFRESH_CONCURRENCY)
+        
+        async def refresh(key: '_CacheKey', entry: _CacheEntry) -> None:
+            policy, agent_id, _ = key
+            async with limit:
+                try:
+                    # Shared with requests that miss the cache meanwhile
+                    await asyncio.shield(self._shared_verification(key, policy, agent_id, entry.context))
+                except Exception as error:
+                    # Leave the entry to expire; the next request verifies again
+                    logger.warning("Failed to refresh verification for agent %s: %s", agent_id, error)
+                    return
+            # A refresh is not a use: keep the original last access time so
+            # entries nobody requests stop being refreshed
+            refreshed = self._cache.get(key)
+            if refreshed is not None:
+                refreshed.last_used = entry.last_used
+        
+        await asyncio.gather(*(refresh(key, entry) for key, entry in expiring))
+    
+    async def aclose(self) -> None:
+        """Stop background work and close the APort client's connections."""
+        task, self._refresh_task = self._refresh_task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        # Send a batch still waiting on its timer rather than dropping it
+        if self._batch_timer is not None:
+            self._batch_timer.cancel()
+            self._flush_batch()
+        if self._batch_tasks:
+            # Batch errors belong to their callers; they must not stop the
+            # client from being closed below
+            await asyncio.gather(*self._batch_tasks, return_exceptions=True)
+        # Only close a client that was actually created
+        client = self.__dict__.pop('client', None)
+        if client is not None:
+            await client.aclose()
+    
+    @asynccontextmanager
+    async def lifespan(self, app: FastAPI) -> AsyncIterator[None]:
+        """Lifespan handler that shares the APort client and closes it on shutdown.
+        
+        Pass it as ``FastAPI(lifespan=middleware.lifespan)``, or enter it from
+        your own lifespan with ``async with middleware.lifespan(app):``. The
+        client is exposed as ``app.state.aport_client``.
+        
+        Args:
+            app: FastAPI application
+        """
+        app.state.aport_client = self.client
+        try:
+            yield
+        finally:
+            await self.aclose()
     
     def require_policy(
         self,
         policy: str,
         context: Optional[Dict[str, Any]] = None,
-        strict: bool = True
+        strict: bool = True,
+        conditional: bool = False
     ) -> Callable:
         """Create a dependency that requires a specific policy.
         
         Args:
             policy: Policy pack identifier
-            context: Additional context for verification
+            context: Additional context for verification. It is copied when
+                the dependency is created; later changes to the dict are not
+                seen by the dependency.
             strict: Whether to fail on verification errors
+            conditional: Tag verified responses with an ETag derived from the
+                passport version, and answer GET/HEAD requests whose
+                If-None-Match matches it with 304 without running the route.
+                Only use this on routes whose response depends on nothing
+                but the verification.
             
         Returns:
-            FastAPI dependency function
+            FastAPI dependency function. Identical arguments with a hashable
+            context return the same function, so FastAPI resolves it once
+            per request even when it is declared on both a router and a route.
         """
-        async def policy_dependency(request: Request) -> Dict[str, Any]:
+        # Unhashable contexts are not shared
+        context_key = _context_key(context)
+        if context_key is None:
+            return self._make_dependency(policy, context, strict, conditional)
+        spec = (policy, context_key, strict, conditional)
+        dependency = self._dependencies.get(spec)
+        if dependency is None:
+            dependency = self._dependencies[spec] = self._make_dependency(policy, context, strict, conditional)
+        return dependency
+    
+    def _make_dependency(
+        self,
+        policy: str,
+        context: Optional[Dict[str, Any]],
+        strict: bool,
+        conditional: bool
+    ) -> Callable:
+        """Build the dependency returned by ``require_policy``."""
+        # Snapshot the caller's context once; it is merged into every request
+        context_items = tuple((context or {}).items())
+        
+        async def policy_dependency(request: Request, response: Response) -> Dict[str, Any]:
             """FastAPI dependency that verifies the policy."""
+            # Only the extraction and the client call can fail unexpectedly;
+            # the 400/403 responses below are raised outside the try block.
             try:
                 # Extract agent ID from request
-                agent_id = self._extract_agent_id(request)
-                
-                if not agent_id:
-                    raise HTTPException(
-                        status_code=400,
-                        detail={
-                            'error': 'Agent ID required',
-                            'message': 'Agent ID must be provided in headers, query, or body'
-                        }
-                    )
-                
-                # Prepare verification context
-                verification_context = {
-                    'method': request.method,
-                    'path': request.url.path,
-                    'user_agent': request.headers.get('user-agent'),
-                    'ip': request.client.host if request.client else None,
-                    **(context or {})
-                }
-                
-                # Verify agent against policy
-                result = await self.client.verify(
-                    policy=policy,
-                    agent_id=agent_id,
-                    context=verification_context
-                )
+                agent_id, user_agent = await self._extract_agent_id(request)
                 
-                if not result.verified:
-                    raise HTTPException(
-                        status_code=403,
-                        detail={
-                            'error': 'Verification failed',
-                            'message': result.message or 'Agent verification failed',
-                            'details': result.details
-                        }
+                if agent_id:
+                    # Prepare verification context straight from the ASGI
+                    # scope rather than the Request's URL and Headers wrappers
+                    verification_context = _request_context(request.scope, user_agent)
+                    verification_context.update(context_items)
+                    
+                    # Verify agent against policy
+                    result = await _timed_verify(
+                        self, request.scope, policy, agent_id, verification_context
                     )
-                
-                # Return verification result
-                return {
-                    'verified': True,
-                    'passport': result.passport,
-                    'policy': policy,
-                    'agent_id': agent_id,
-                    'result': result
-                }
-                
-            except HTTPException:
-                raise
             except Exception as error:
                 if strict:
-                    raise HTTPException(
-                        status_code=500,
-                        detail={
-                            'error': 'Verification error',
-                            'message': 'Internal verification error'
-                        }
-                    )
+                    raise HTTPException(status_code=500, detail=_VERIFICATION_ERROR)
                 
                 # In non-strict mode, return unverified result
                 return {
                     'verified': False,
                     'error': str(error)
                 }
+            
+            if not agent_id:
+                raise HTTPException(status_code=400, detail=_AGENT_ID_REQUIRED)
+            
+            if not result.verified:
+                raise HTTPException(
+                    status_code=403,
+                    detail={
+                        'error': 'Verification failed',
+                        'message': result.message or 'Agent verification failed',
+                        'details': result.details
+                    }
+                )
+            
+            if conditional:
+                etag = _verification_etag(policy, agent_id, result.passport)
+                headers = {
+                    'ETag': etag,
+                    'Cache-Control': f'private, must-revalidate, stale-while-revalidate={int(self.cache_ttl)}'
+                }
+                if request.method in _CONDITIONAL_METHODS and _etag_matches(
+                    request.headers.get('if-none-match'), etag
+                ):
+                    raise HTTPException(status_code=304, headers=headers)
+                response.headers.update(headers)
+            
+            # Return verification result. The passport is copied because the
+            # result may be cached and shared with later requests.
+            return {
+                'verified': True,
+                'passport': copy.deepcopy(result.passport),
+                'policy': policy,
+                'agent_id': agent_id
+            }
         
         return policy_dependency
     
-    def _extract_agent_id(self, request: Request) -> Optional[str]:
+    async def _extract_agent_id(self, request: Request) -> Tuple[Optional[str], Optional[str]]:
         """Extract agent ID from request.
         
+        The body is only read when the headers and query string have no
+        agent ID, and only for JSON requests. Starlette caches the parsed
+        body on the request, so route handlers calling ``request.json()``
+        do not parse it again.
+        
         Args:
             request: FastAPI request object
             
         Returns:
-            Agent ID or None if not found
+            Tuple of the agent ID and the User-Agent header, either of which
+            may be None. Both come from the same pass over the headers.
         """
         # Check headers
-        agent_id = request.headers.get('x-agent-id') or request.headers.get('x-aport-agent-id')
+        agent_id, user_agent = _scan_headers(request.scope['headers'])
         if agent_id:
-            return agent_id
+            return agent_id, user_agent
         
         # Check query parameters
-        agent_id = request.query_params.get('agent_id')
+        agent_id = request.query_params.get(_AGENT_ID_QUERY_PARAM)
         if agent_id:
-            return agent_id
+            return agent_id, user_agent
         
-        # Check JSON body (if available)
-        if hasattr(request, '_json') and request._json:
-            agent_id = request._json.get('agent_id') or request._json.get('agentId')
-            if agent_id:
-                return agent_id
+        # Check JSON body
+        if 'json' not in request.headers.get('content-type', ''):
+            return None, user_agent
+        try:
+            body = await request.json()
+        except ValueError:
+            return None, user_agent
+        if isinstance(body, dict):
+            for key in _AGENT_ID_BODY_KEYS:
+                agent_id = body.get(key)
+                if agent_id:
+                    return agent_id, user_agent
         
-        return None
+        return None, user_agent
+
+
+# Middleware instances shared by require_policy, keyed by (api_key, base_url)
+_shared_middleware: Dict[Tuple[Optional[str], Optional[str]], APortMiddleware] = {}
+
+
+def _get_shared_middleware(
+    api_key: Optional[str] = None,
+    base_url: Optional[str] = None
+) -> APortMiddleware:
+    """Return the process-wide middleware for the given credentials."""
+    key = (api_key, base_url)
+    middleware = _shared_middleware.get(key)
+    if middleware is None:
+        middleware = _shared_middleware[key] = APortMiddleware(api_key=api_key, base_url=base_url)
+    return middleware
 
 
 # Convenience function for creating policy dependencies
@@ -186,19 +591,289 @@ def require_policy(
     context: Optional[Dict[str, Any]] = None,
     strict: bool = True,
     api_key: Optional[str] = None,
-    base_url: Optional[str] = None
+    base_url: Optional[str] = None,
+    conditional: bool = False
 ) -> Callable:
     """Create a policy dependency without instantiating middleware.
     
+    Dependencies created with the same api_key and base_url share one
+    APortMiddleware, and therefore one client and verification cache.
+    
     Args:
         policy: Policy pack identifier
         context: Additional context for verification
         strict: Whether to fail on verification errors
         api_key: APort API key
         base_url: APort API base URL
+        conditional: Answer matching If-None-Match requests with 304; see
+            ``APortMiddleware.require_policy``
         
     Returns:
         FastAPI dependency function
     """
-    middleware = APortMiddleware(api_key=api_key, base_url=base_url)
-    return middleware.require_policy(policy, context, strict)
+    middleware = _get_shared_middleware(api_key, base_url)
+    return middleware.require_policy(policy, context, strict, conditional)
+
+
+async def aclose_shared_middleware() -> None:
+    """Close the middleware instances shared by ``require_policy``.
+    
+    Call this on application shutdown, e.g. from the lifespan handler, when
+    dependencies were created with the module-level ``require_policy``.
+    """
+    shared = list(_shared_middleware.values())
+    _shared_middleware.clear()
+    for middleware in shared:
+        await middleware.aclose()
+
+
+class APortASGIMiddleware:
+    """Pure ASGI middleware that enforces APort policies before routing.
+    
+    Unlike ``require_policy`` dependencies, the check runs before FastAPI
+    builds a ``Request`` or resolves dependencies, and requests for paths
+    that match neither ``policies`` nor ``prefix_policies`` are passed
+    through after a dict lookup and a single ``str.startswith`` call.
+    The agent ID is read from the ``X-Agent-ID``/``X-APort-Agent-ID``
+    headers or the ``agent_id`` query parameter; the request body is not
+    read. On success the verification data is stored on the request
+    state and available to handlers as ``request.state.aport``.
+    
+    Example:
+        app.add_middleware(
+            APortASGIMiddleware,
+            policies={"/refund": "finance.payment.refund.v1"},
+            prefix_policies={"/admin/": "admin.access"},
+        )
+    """
+    
+    def __init__(
+        self,
+        app: ASGIApp,
+        policies: Optional[Dict[str, str]] = None,
+        aport: Optional[APortMiddleware] = None,
+        strict: bool = True,
+        api_key: Optional[str] = None,
+        base_url: Optional[str] = None,
+        prefix_policies: Optional[Dict[str, str]] = None
+    ):
+        """Initialize the ASGI middleware.
+        
+        Args:
+            app: ASGI application to wrap
+            policies: Mapping of exact request path to policy pack identifier
+            aport: APort middleware whose client is used for verification.
+                If not provided, one is created from api_key and base_url.
+            strict: Whether to fail on verification errors
+            api_key: APort API key
+            base_url: APort API base URL
+            prefix_policies: Mapping of request path prefix to policy pack
+                identifier. Exact matches in ``policies`` take precedence,
+                then the longest matching prefix.
+        """
+        self.app = app
+        self.policies = dict(policies or {})
+        self.prefix_policies = dict(prefix_policies or {})
+        # Longest first, so the first match in __call__ is the most specific
+        self._prefixes = tuple(sorted(self.prefix_policies, key=len, reverse=True))
+        self.aport = aport or APortMiddleware(api_key=api_key, base_url=base_url)
+        self.strict = strict
+    
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        
+        path = scope['path']
+        policy = self.policies.get(path)
+        if policy is None:
+            if not path.startswith(self._prefixes):
+                await self.app(scope, receive, send)
+                return
+            policy = next(
+                self.prefix_policies[prefix]
+                for prefix in self._prefixes
+                if path.startswith(prefix)
+            )
+        
+        agent_id, user_agent = _scan_headers(scope['headers'])
+        if not agent_id and scope['query_string']:
+            query = dict(parse_qsl(scope['query_string'].decode('latin-1')))
+            agent_id = query.get(_AGENT_ID_QUERY_PARAM)
+        
+        if not agent_id:
+            await _send_json(send, 400, _ASGI_AGENT_ID_REQUIRED_BODY)
+            return
+        
+        try:
+            result = await _timed_verify(
+                self.aport, scope, policy, agent_id, _request_context(scope, user_agent)
+            )
+        except Exception as error:
+            if self.strict:
+                await _send_json(send, 500, _VERIFICATION_ERROR_BODY)
+                return
+            aport_data = {'verified': False, 'error': str(error)}
+        else:
+            if not result.verified:
+                await _send_json(send, 403, _json_detail({
+                    'error': 'Verification failed',
+                    'message': result.message or 'Agent verification failed',
+                    'details': result.details
+                }))
+                return
+            aport_data = {
+                'verified': True,
+                # Copied so handlers cannot change a cached result
+                'passport': copy.deepcopy(result.passport),
+                'policy': policy,
+                'agent_id': agent_id
+            }
+        
+        scope.setdefault('state', {})['aport'] = aport_data
+        await self.app(scope, receive, send)
+
+
+class APortTimingMiddleware:
+    """Pure ASGI middleware that reports verification time in ``Server-Timing``.
+    
+    Adds ``Server-Timing: verify;dur=<ms>, total;dur=<ms>`` to every HTTP
+    response, where ``verify`` is the time spent in APort verification for
+    the request and ``total`` the time until the response started. Add it
+    after ``APortASGIMiddleware`` so that it wraps it. Use this rather than
+    an ``@app.middleware("http")`` function, which runs the app through
+    ``BaseHTTPMiddleware`` and slows every request.
+    
+    Example:
+        app.add_middleware(APortTimingMiddleware)
+    """
+    
+    def __init__(self, app: ASGIApp):
+        """Initialize the timing middleware.
+        
+        Args:
+            app: ASGI application to wrap
+        """
+        self.app = app
+    
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        """Handle an ASGI connection."""
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        
+        start = time.perf_counter_ns()
+        
+        async def send_with_timing(message: Message) -> None:
+            if message['type'] == 'http.response.start':
+                total = f'total;dur={(time.perf_counter_ns() - start) / 1e6:.2f}'
+                verify_ns = scope.get('state', {}).get('aport_verify_ns')
+                if verify_ns is not None:
+                    total = f'verify;dur={verify_ns / 1e6:.2f}, {total}'
+                message['headers'] = [*message.get('headers', ()), (b'server-timing', total.encode('latin-1'))]
+            await send(message)
+        
+        await self.app(scope, receive, send_with_timing)
+
+
+async def _timed_verify(
+    aport: APortMiddleware,
+    scope: Scope,
+    policy: str,
+    agent_id: str,
+    context: Dict[str, Any]
+) -> MockVerificationResult:
+    """Verify, adding the time taken to ``scope['state']['aport_verify_ns']``."""
+    start = time.perf_counter_ns()
+    try:
+        return await aport.verify(policy=policy, agent_id=agent_id, context=context)
+    finally:
+        state = scope.setdefault('state', {})
+        state['aport_verify_ns'] = state.get('aport_verify_ns', 0) + time.perf_counter_ns() - start
+
+
+def _context_key(context: Optional[Dict[str, Any]]) -> Optional[_ContextKey]:
+    """Key a context by its items independently of order, or None if unhashable."""
+    try:
+        return frozenset((key, type(value), value) for key, value in (context or {}).items())
+    except TypeError:
+        return None
+
+
+def _verification_etag(policy: str, agent_id: str, passport: Dict[str, Any]) -> str:
+    """Build an ETag for a verification from the passport version.
+    
+    Falls back to the whole passport when it has no version.
+    """
+    version = passport.get('version', passport)
+    encoded = json.dumps([policy, agent_id, version], sort_keys=True, separators=(',', ':'), default=str)
+    return '"%s"' % hashlib.blake2b(encoded.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Check an If-None-Match header against an ETag (weak comparison)."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    return any(tag.strip().removeprefix('W/') == etag for tag in if_none_match.split(','))
+
+
+def _request_context(scope: Scope, user_agent: Optional[str]) -> Dict[str, Any]:
+    """Build the per-request verification context from an HTTP scope."""
+    client = scope.get('client')
+    return {
+        'method': scope['method'],
+        'path': scope['path'],
+        'user_agent': user_agent,
+        'ip': client[0] if client else None
+    }
+
+
+def _scan_headers(raw_headers: Iterable[Tuple[bytes, bytes]]) -> Tuple[Optional[str], Optional[str]]:
+    """Find the agent ID and user agent in raw ASGI headers in one pass.
+    
+    Header names in ASGI scopes are already lower-cased. When several agent
+    ID headers are present, the earliest name in ``_AGENT_ID_HEADERS`` wins.
+    
+    Returns:
+        Tuple of (agent ID, user agent); either may be None
+    """
+    found: Dict[bytes, bytes] = {}
+    user_agent = None
+    for name, value in raw_headers:
+        if name in _RAW_AGENT_ID_HEADERS:
+            if value and name not in found:
+                found[name] = value
+        elif name == _RAW_USER_AGENT_HEADER and user_agent is None:
+            user_agent = value.decode('latin-1')
+    for name in _RAW_AGENT_ID_HEADERS:
+        if name in found:
+            return found[name].decode('latin-1'), user_agent
+    return None, user_agent
+
+
+def _json_detail(detail: Dict[str, Any]) -> bytes:
+    """Encode an error payload the way FastAPI renders an HTTPException."""
+    return json.dumps({'detail': detail}).encode('utf-8')
+
+
+# The ASGI middleware never reads the body, so its 400 message says so
+_ASGI_AGENT_ID_REQUIRED_BODY = _json_detail({
+    'error': 'Agent ID required',
+    'message': 'Agent ID must be provided in headers or query'
+})
+_VERIFICATION_ERROR_BODY = _json_detail(_VERIFICATION_ERROR)
+
+
+async def _send_json(send: Send, status_code: int, body: bytes) -> None:
+    """Send a JSON error response."""
+    await send({
+        'type': 'http.response.start',
+        'status': status_code,
+        'headers': [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(body)).encode('latin-1'))
+        ]
+    })
+    await send({'type': 'http.response.body', 'body': body})
@@ -1,20 +1,40 @@
 """Tests for APort FastAPI middleware."""
 
+import asyncio
+import copy
+import pickle
+import re
+from contextlib import asynccontextmanager
+from datetime import datetime
+from decimal import Decimal
+
 import pytest
 from unittest.mock import AsyncMock, patch
-from fastapi import FastAPI, Request
-from fastapi.testclient import TestClient
-from aport_middleware import APortMiddleware, require_policy
+from asgi_lifespan import LifespanManager
+from fastapi import Depends, FastAPI, Request
+from httpx import ASGITransport, AsyncClient
+from aport_middleware import (
+    APortASGIMiddleware,
+    APortError,
+    APortMiddleware,
+    APortTimingMiddleware,
+    aclose_shared_middleware,
+    require_policy,
+)
+from aport_middleware.middleware import MockVerificationResult, _shared_middleware
 
 
-@pytest.fixture
-def app():
+@pytest.fixture(scope="module")
+def middleware():
+    """Create one middleware instance shared by the module's tests."""
+    return APortMiddleware(api_key="test-key", cache_ttl=0)
+
+
+@pytest.fixture(scope="module")
+def app(middleware):
     """Create test FastAPI app."""
     app = FastAPI()
     
-    # Initialize middleware
-    middleware = APortMiddleware(api_key="test-key")
-    
     @app.get("/public")
     async def public():
         return {"message": "public"}
@@ -22,49 +42,68 @@ def app():
     @app.post("/refund")
     async def refund(
         request: Request,
-        aport_data: dict = middleware.require_policy("finance.payment.refund.v1")
+        aport_data: dict = Depends(
+            middleware.require_policy("finance.payment.refund.v1")
+        )
     ):
         return {"success": True, "agent_id": aport_data["agent_id"]}
     
     return app
 
 
+@asynccontextmanager
+async def serve(app):
+    """Run the app's lifespan and yield an async client calling it in-process."""
+    async with LifespanManager(app) as manager:
+        transport = ASGITransport(app=manager.app)
+        async with AsyncClient(transport=transport, base_url="http://test") as client:
+            yield client
+
+
 @pytest.fixture
-def client(app):
+async def client(app):
     """Create test client."""
-    return TestClient(app)
+    async with serve(app) as client:
+        yield client
 
 
 @pytest.fixture
-def mock_verify():
+def mock_verify(middleware):
     """Mock APort client verify method."""
-    with patch('aport_middleware.middleware.APortClient') as mock_client:
-        mock_instance = AsyncMock()
-        mock_client.return_value = mock_instance
-        yield mock_instance.verify
+    with patch.object(middleware.client, "verify", new_callable=AsyncMock) as verify:
+        yield verify
+
+
+def verification_result(verified=True, passport=None, message="", details=None):
+    """Build a verification result as returned by the APort client."""
+    return MockVerificationResult(
+        verified=verified,
+        passport=passport or {},
+        policy="finance.payment.refund.v1",
+        message=message,
+        details=details
+    )
 
 
 class TestAPortMiddleware:
     """Test APort middleware functionality."""
     
-    def test_public_endpoint(self, client):
+    async def test_public_endpoint(self, client):
         """Test that public endpoints work without verification."""
-        response = client.get("/public")
+        response = await client.get("/public")
         assert response.status_code == 200
         assert response.json()["message"] == "public"
     
-    @pytest.mark.asyncio
     async def test_successful_verification(self, client, mock_verify):
         """Test successful agent verification."""
-        mock_verify.return_value = {
-            "verified": True,
-            "passport": {
+        mock_verify.return_value = verification_result(
+            passport={
                 "capabilities": ["refund"],
                 "limits": {"refund_amount_max_per_tx": 1000}
             }
-        }
+        )
         
-        response = client.post(
+        response = await client.post(
             "/refund",
             headers={"X-Agent-ID": "agt_test123"},
             json={"amount": 100}
@@ -75,81 +114,658 @@ class TestAPortMiddleware:
         assert response.json()["agent_id"] == "agt_test123"
         mock_verify.assert_called_once()
     
-    @pytest.mark.asyncio
     async def test_failed_verification(self, client, mock_verify):
         """Test failed agent verification."""
-        mock_verify.return_value = {
-            "verified": False,
-            "message": "Agent not authorized"
-        }
+        mock_verify.return_value = verification_result(
+            verified=False,
+            message="Agent not authorized"
+        )
         
-        response = client.post(
+        response = await client.post(
             "/refund",
             headers={"X-Agent-ID": "agt_unauthorized"},
             json={"amount": 100}
         )
         
         assert response.status_code == 403
-        assert response.json()["error"] == "Verification failed"
-        assert response.json()["message"] == "Agent not authorized"
+        assert response.json()["detail"]["error"] == "Verification failed"
+        assert response.json()["detail"]["message"] == "Agent not authorized"
     
-    def test_missing_agent_id(self, client):
+    async def test_missing_agent_id(self, client):
         """Test request without agent ID."""
-        response = client.post("/refund", json={"amount": 100})
+        response = await client.post("/refund", json={"amount": 100})
         
         assert response.status_code == 400
-        assert response.json()["error"] == "Agent ID required"
+        assert response.json()["detail"]["error"] == "Agent ID required"
     
-    @pytest.mark.asyncio
     async def test_verification_error(self, client, mock_verify):
         """Test verification API error."""
         mock_verify.side_effect = Exception("API Error")
         
-        response = client.post(
+        response = await client.post(
             "/refund",
             headers={"X-Agent-ID": "agt_test123"},
             json={"amount": 100}
         )
         
         assert response.status_code == 500
-        assert response.json()["error"] == "Verification error"
+        assert response.json()["detail"]["error"] == "Verification error"
     
-    def test_agent_id_extraction_headers(self, client, mock_verify):
-        """Test agent ID extraction from headers."""
-        mock_verify.return_value = {"verified": True, "passport": {}}
+    @pytest.mark.parametrize(
+        "url, request_kwargs, agent_id",
+        [
+            ("/refund", {"headers": {"X-Agent-ID": "agt_header123"}}, "agt_header123"),
+            ("/refund", {"headers": {"X-APort-Agent-ID": "agt_aport123"}}, "agt_aport123"),
+            ("/refund?agent_id=agt_query123", {}, "agt_query123"),
+            ("/refund", {"json": {"amount": 100, "agent_id": "agt_body123"}}, "agt_body123"),
+        ],
+        ids=["header", "aport_header", "query", "body"]
+    )
+    async def test_agent_id_extraction(self, client, mock_verify, url, request_kwargs, agent_id):
+        """Test agent ID extraction from headers, query parameters and body."""
+        mock_verify.return_value = verification_result()
         
-        response = client.post(
-            "/refund",
-            headers={"X-Agent-ID": "agt_header123"},
-            json={"amount": 100}
-        )
+        response = await client.post(url, **{"json": {"amount": 100}, **request_kwargs})
         
         assert response.status_code == 200
+        assert response.json()["agent_id"] == agent_id
         mock_verify.assert_called_once()
     
-    def test_agent_id_extraction_query(self, client, mock_verify):
-        """Test agent ID extraction from query parameters."""
-        mock_verify.return_value = {"verified": True, "passport": {}}
+    async def test_non_json_body_is_not_parsed(self, client, mock_verify):
+        """Test that non-JSON bodies are not searched for an agent ID."""
+        response = await client.post(
+            "/refund",
+            content=b"agent_id=agt_form123",
+            headers={"content-type": "application/x-www-form-urlencoded"}
+        )
+        
+        assert response.status_code == 400
+        mock_verify.assert_not_called()
+    
+    async def test_agent_id_header_precedence(self, client, mock_verify):
+        """Test that X-Agent-ID wins over X-APort-Agent-ID."""
+        mock_verify.return_value = verification_result()
         
-        response = client.post(
-            "/refund?agent_id=agt_query123",
+        response = await client.post(
+            "/refund",
+            headers={"X-APort-Agent-ID": "agt_aport123", "X-Agent-ID": "agt_header123"},
             json={"amount": 100}
         )
         
         assert response.status_code == 200
-        mock_verify.assert_called_once()
+        assert response.json()["agent_id"] == "agt_header123"
     
-    def test_agent_id_extraction_body(self, client, mock_verify):
-        """Test agent ID extraction from request body."""
-        mock_verify.return_value = {"verified": True, "passport": {}}
+    async def test_concurrent_requests(self, client, mock_verify):
+        """Test that concurrent requests each get their own agent's result."""
+        async def slow_verify(policy, agent_id, context):
+            await asyncio.sleep(0.01)
+            return verification_result(passport={"agentId": agent_id})
+        mock_verify.side_effect = slow_verify
         
-        response = client.post(
-            "/refund",
-            json={"amount": 100, "agent_id": "agt_body123"}
+        responses = await asyncio.gather(*(
+            client.post("/refund", headers={"X-Agent-ID": f"agt_{i}"}, json={"amount": 100})
+            for i in range(5)
+        ))
+        
+        assert [response.json()["agent_id"] for response in responses] == [f"agt_{i}" for i in range(5)]
+        assert mock_verify.call_count == 5
+
+
+class TestVerificationContext:
+    """Test the context passed to the APort client."""
+    
+    async def test_context_is_merged_and_snapshotted(self, middleware, mock_verify):
+        """Test that route context is merged at creation time."""
+        mock_verify.return_value = verification_result()
+        route_context = {"endpoint": "refund"}
+        dependency = middleware.require_policy("finance.payment.refund.v1", context=route_context)
+        route_context["endpoint"] = "changed"
+        
+        app = FastAPI()
+        
+        @app.post("/refund")
+        async def refund(aport_data: dict = Depends(dependency)):
+            return {"agent_id": aport_data["agent_id"]}
+        
+        async with serve(app) as client:
+            response = await client.post(
+                "/refund", headers={"X-Agent-ID": "agt_test123", "User-Agent": "agent-sdk/1.0"}
+            )
+        
+        assert response.status_code == 200
+        assert mock_verify.call_args.kwargs["context"] == {
+            "method": "POST",
+            "path": "/refund",
+            "user_agent": "agent-sdk/1.0",
+            "ip": "127.0.0.1",
+            "endpoint": "refund",
+        }
+    
+    async def test_dependency_result_is_json_native(self, middleware, mock_verify):
+        """Test that the dependency result can be returned from a route."""
+        mock_verify.return_value = verification_result(passport={"capabilities": ["refund"]})
+        dependency = middleware.require_policy("finance.payment.refund.v1")
+        
+        app = FastAPI()
+        
+        @app.get("/whoami")
+        async def whoami(aport_data: dict = Depends(dependency)):
+            return aport_data
+        
+        async with serve(app) as client:
+            response = await client.get("/whoami", headers={"X-Agent-ID": "agt_test123"})
+        
+        assert response.json() == {
+            "verified": True,
+            "passport": {"capabilities": ["refund"]},
+            "policy": "finance.payment.refund.v1",
+            "agent_id": "agt_test123"
+        }
+    
+    def test_identical_dependencies_are_shared(self, middleware):
+        """Test that require_policy reuses the dependency for identical arguments."""
+        dependency = middleware.require_policy("shared.v1", context={"a": 1, "b": 2})
+        
+        assert middleware.require_policy("shared.v1", context={"b": 2, "a": 1}) is dependency
+        assert middleware.require_policy("shared.v1", context={"a": 2, "b": 2}) is not dependency
+        assert middleware.require_policy("shared.v1", context={"a": 1, "b": 2}, strict=False) is not dependency
+    
+    @pytest.mark.parametrize(
+        "first, second",
+        [
+            ({"v": "1"}, {"v": Decimal("1")}),
+            ({"v": 1}, {"v": True}),
+        ]
+    )
+    def test_distinct_contexts_are_not_shared(self, middleware, first, second):
+        """Test that contexts that only serialize alike get their own dependency."""
+        assert middleware.require_policy("distinct.v1", context=first) is not middleware.require_policy(
+            "distinct.v1", context=second
+        )
+    
+    def test_unhashable_context_is_not_shared(self, middleware):
+        """Test that contexts with unhashable values still work, uncached."""
+        context = {"scopes": ["read"]}
+        
+        dependency = middleware.require_policy("unhashable.v1", context=context)
+        
+        assert callable(dependency)
+        assert middleware.require_policy("unhashable.v1", context=context) is not dependency
+
+
+class TestVerificationResult:
+    """Test the verification result type."""
+    
+    def test_result_is_immutable(self):
+        """Test that a result, which may be cached and shared, cannot be changed."""
+        result = verification_result()
+        
+        with pytest.raises(AttributeError):
+            result.verified = False
+        with pytest.raises(AttributeError):
+            result.extra = True
+        assert result.verified is True
+    
+    @pytest.mark.parametrize(
+        "clone",
+        [copy.copy, copy.deepcopy, lambda result: pickle.loads(pickle.dumps(result))],
+        ids=["copy", "deepcopy", "pickle"]
+    )
+    def test_result_can_be_copied_and_pickled(self, clone):
+        """Test that copy, deepcopy and pickle work despite the immutability guard."""
+        result = verification_result(
+            verified=False,
+            passport={"capabilities": ["read"]},
+            message="denied",
+            details={"reason": "limit"}
         )
         
+        cloned = clone(result)
+        
+        assert cloned is not result
+        assert [getattr(cloned, name) for name in MockVerificationResult.__slots__] == [
+            getattr(result, name) for name in MockVerificationResult.__slots__
+        ]
+
+
+class TestConditionalResponses:
+    """Test ETag handling in conditional dependencies."""
+    
+    @pytest.fixture
+    async def conditional_client(self, middleware):
+        """Create an app with a conditional and a non-conditional route."""
+        app = FastAPI()
+        dependency = middleware.require_policy("profile.read.v1", conditional=True)
+        
+        @app.get("/profile")
+        async def profile(aport_data: dict = Depends(dependency)):
+            return {"agent_id": aport_data["agent_id"]}
+        
+        @app.post("/profile")
+        async def update_profile(aport_data: dict = Depends(dependency)):
+            return {"updated": True}
+        
+        async with serve(app) as client:
+            yield client
+    
+    async def test_etag_round_trip(self, conditional_client, mock_verify):
+        """Test that a matching If-None-Match returns 304 with no body."""
+        mock_verify.return_value = verification_result(passport={"version": 3})
+        headers = {"X-Agent-ID": "agt_test123"}
+        
+        first = await conditional_client.get("/profile", headers=headers)
+        etag = first.headers["etag"]
+        second = await conditional_client.get("/profile", headers={**headers, "If-None-Match": etag})
+        
+        assert first.status_code == 200
+        assert "stale-while-revalidate" in first.headers["cache-control"]
+        assert second.status_code == 304
+        assert second.content == b""
+        assert second.headers["etag"] == etag
+    
+    async def test_changed_passport_version_changes_etag(self, conditional_client, mock_verify):
+        """Test that a new passport version no longer matches the old ETag."""
+        headers = {"X-Agent-ID": "agt_test123"}
+        mock_verify.return_value = verification_result(passport={"version": 3})
+        etag = (await conditional_client.get("/profile", headers=headers)).headers["etag"]
+        
+        mock_verify.return_value = verification_result(passport={"version": 4})
+        response = await conditional_client.get("/profile", headers={**headers, "If-None-Match": etag})
+        
         assert response.status_code == 200
-        mock_verify.assert_called_once()
+        assert response.headers["etag"] != etag
+    
+    async def test_unsafe_methods_are_not_short_circuited(self, conditional_client, mock_verify):
+        """Test that POST requests always reach the route."""
+        mock_verify.return_value = verification_result(passport={"version": 3})
+        headers = {"X-Agent-ID": "agt_test123"}
+        etag = (await conditional_client.get("/profile", headers=headers)).headers["etag"]
+        
+        response = await conditional_client.post("/profile", headers={**headers, "If-None-Match": etag})
+        
+        assert response.status_code == 200
+        assert response.json() == {"updated": True}
+
+
+class TestVerificationCache:
+    """Test caching of verification results."""
+    
+    @pytest.fixture
+    def cached(self):
+        """Create a middleware with caching enabled and a mocked client."""
+        middleware = APortMiddleware(api_key="test-key", cache_ttl=30, cache_size=2)
+        with patch.object(middleware.client, "verify", new_callable=AsyncMock) as verify:
+            verify.return_value = verification_result()
+            yield middleware, verify
+    
+    async def test_handlers_cannot_change_cached_passport(self, cached):
+        """Test that a route mutating its passport does not change the cache."""
+        middleware, verify = cached
+        verify.return_value = verification_result(
+            passport={"capabilities": ["read"], "limits": {"requests": 1000}}
+        )
+        app = FastAPI()
+        
+        @app.get("/escalate")
+        async def escalate(aport_data: dict = Depends(middleware.require_policy("policy.v1"))):
+            passport = aport_data["passport"]
+            response = {"capabilities": list(passport["capabilities"])}
+            passport["capabilities"].append("admin")
+            passport["limits"]["requests"] = 999999
+            return response
+        
+        async with serve(app) as client:
+            first = await client.get("/escalate", headers={"X-Agent-ID": "agt_1"})
+            second = await client.get("/escalate", headers={"X-Agent-ID": "agt_1"})
+        
+        assert first.json() == second.json() == {"capabilities": ["read"]}
+        verify.assert_called_once()
+        cached_passport = next(iter(middleware._cache.values())).result.passport
+        assert cached_passport == {"capabilities": ["read"], "limits": {"requests": 1000}}
+    
+    async def test_repeated_verification_is_cached(self, cached):
+        """Test that identical verifications reuse the cached result."""
+        middleware, verify = cached
+        
+        first = await middleware.verify("policy.v1", "agt_1", {"a": 1, "b": 2})
+        second = await middleware.verify("policy.v1", "agt_1", {"b": 2, "a": 1})
+        
+        assert first is second
+        verify.assert_called_once()
+    
+    async def test_different_keys_are_not_shared(self, cached):
+        """Test that policy, agent and context are all part of the key."""
+        middleware, verify = cached
+        
+        await middleware.verify("policy.v1", "agt_1", {"a": 1})
+        await middleware.verify("policy.v2", "agt_1", {"a": 1})
+        await middleware.verify("policy.v1", "agt_2", {"a": 1})
+        await middleware.verify("policy.v1", "agt_1", {"a": 2})
+        
+        assert verify.call_count == 4
+    
+    @pytest.mark.parametrize(
+        "first, second",
+        [
+            ({"limit": "1"}, {"limit": Decimal("1")}),
+            ({"at": "2024-01-01 00:00:00"}, {"at": datetime(2024, 1, 1)}),
+            ({"flag": 1}, {"flag": True}),
+        ]
+    )
+    async def test_contexts_that_serialize_alike_are_not_shared(self, cached, first, second):
+        """Test that the cache keys on context values, not their string form."""
+        middleware, verify = cached
+        
+        await middleware.verify("policy.v1", "agt_1", first)
+        await middleware.verify("policy.v1", "agt_1", second)
+        
+        assert verify.call_count == 2
+    
+    @pytest.mark.parametrize(
+        "context",
+        [{1: "a", "b": 2}, {("x", 1): "a"}],
+        ids=["mixed_keys", "tuple_key"]
+    )
+    async def test_non_json_keys_are_cached(self, cached, context):
+        """Test that contexts json.dumps cannot sort or encode still work."""
+        middleware, verify = cached
+        
+        await middleware.verify("policy.v1", "agt_1", context)
+        await middleware.verify("policy.v1", "agt_1", dict(context))
+        
+        verify.assert_called_once()
+    
+    async def test_unhashable_context_bypasses_cache(self, cached):
+        """Test that unhashable contexts are verified without caching."""
+        middleware, verify = cached
+        
+        await middleware.verify("policy.v1", "agt_1", {"scopes": ["read"]})
+        await middleware.verify("policy.v1", "agt_1", {"scopes": ["read"]})
+        
+        assert verify.call_count == 2
+        assert len(middleware._cache) == 0
+    
+    async def test_expired_entries_are_refreshed(self, cached):
+        """Test that results are re-verified after the TTL."""
+        middleware, verify = cached
+        
+        with patch("aport_middleware.middleware.time.monotonic", return_value=1000.0):
+            await middleware.verify("policy.v1", "agt_1")
+        with patch("aport_middleware.middleware.time.monotonic", return_value=1031.0):
+            await middleware.verify("policy.v1", "agt_1")
+        
+        assert verify.call_count == 2
+    
+    async def test_cache_size_is_bounded(self, cached):
+        """Test that the least recently used entry is evicted."""
+        middleware, verify = cached
+        
+        await middleware.verify("policy.v1", "agt_1")
+        await middleware.verify("policy.v1", "agt_2")
+        await middleware.verify("policy.v1", "agt_1")
+        await middleware.verify("policy.v1", "agt_3")
+        await middleware.verify("policy.v1", "agt_1")
+        
+        assert verify.call_count == 3
+        assert len(middleware._cache) == 2
+    
+    async def test_concurrent_verifications_are_coalesced(self, cached):
+        """Test that concurrent identical verifications share one call."""
+        middleware, verify = cached
+        
+        async def slow_verify(**kwargs):
+            await asyncio.sleep(0.01)
+            return verification_result()
+        verify.side_effect = slow_verify
+        
+        results = await asyncio.gather(
+            *(middleware.verify("policy.v1", "agt_1") for _ in range(5))
+        )
+        
+        assert all(result is results[0] for result in results)
+        verify.assert_called_once()
+    
+    async def test_errors_are_not_cached(self, cached):
+        """Test that a failed client call is retried on the next request."""
+        middleware, verify = cached
+        verify.side_effect = [Exception("API Error"), verification_result()]
+        
+        with pytest.raises(Exception, match="API Error"):
+            await middleware.verify("policy.v1", "agt_1")
+        result = await middleware.verify("policy.v1", "agt_1")
+        
+        assert result.verified is True
+        assert verify.call_count == 2
+
+
+class TestWarmRefresh:
+    """Test background refresh of cached verification results."""
+    
+    @pytest.fixture
+    async def refreshing(self):
+        """Create a middleware with warm refresh enabled and a mocked client."""
+        middleware = APortMiddleware(api_key="test-key", cache_ttl=30, warm_refresh=True)
+        with patch.object(middleware.client, "verify", new_callable=AsyncMock) as verify:
+            verify.return_value = verification_result()
+            yield middleware, verify
+        await middleware.aclose()
+    
+    async def test_refresh_task_starts_and_stops(self, refreshing):
+        """Test that the refresh task starts with the cache and stops on aclose."""
+        middleware, verify = refreshing
+        
+        await middleware.verify("policy.v1", "agt_1")
+        task = middleware._refresh_task
+        assert task is not None and not task.done()
+        
+        await middleware.aclose()
+        assert task.cancelled()
+        assert middleware._refresh_task is None
+    
+    async def test_expiring_entries_in_use_are_refreshed(self, refreshing):
+        """Test that only recently used entries close to expiry are refreshed."""
+        middleware, verify = refreshing
+        monotonic = "aport_middleware.middleware.time.monotonic"
+        
+        with patch(monotonic, return_value=990.0):
+            await middleware.verify("policy.v1", "agt_cold")
+        with patch(monotonic, return_value=1000.0):
+            await middleware.verify("policy.v1", "agt_hot", {"a": 1})
+        with patch(monotonic, return_value=1010.0):
+            await middleware.verify("policy.v1", "agt_hot", {"a": 1})
+        with patch(monotonic, return_value=1020.0):
+            await middleware._refresh_expiring()
+        
+        assert verify.call_count == 3
+        assert verify.call_args.kwargs == {
+            "policy": "policy.v1", "agent_id": "agt_hot", "context": {"a": 1}
+        }
+    
+    async def test_refresh_shares_call_with_requests(self, refreshing):
+        """Test that a request missing the cache during a refresh joins it."""
+        middleware, verify = refreshing
+        # Refresh by hand: the patched clock would also wake the background loop
+        middleware.warm_refresh = False
+        monotonic = "aport_middleware.middleware.time.monotonic"
+        release = asyncio.Event()
+        
+        async def slow_verify(**kwargs):
+            await release.wait()
+            return verification_result()
+        
+        with patch(monotonic, return_value=1000.0):
+            await middleware.verify("policy.v1", "agt_1")
+        with patch(monotonic, return_value=1010.0):
+            await middleware.verify("policy.v1", "agt_1")
+        verify.side_effect = slow_verify
+        with patch(monotonic, return_value=1031.0):
+            refresh = asyncio.ensure_future(middleware._refresh_expiring())
+            await asyncio.sleep(0)
+            request = asyncio.ensure_future(middleware.verify("policy.v1", "agt_1"))
+            await asyncio.sleep(0)
+            release.set()
+            await asyncio.gather(refresh, request)
+        
+        assert verify.call_count == 2
+    
+    async def test_entries_are_refreshed_concurrently(self, refreshing):
+        """Test that one slow refresh does not hold up the others."""
+        middleware, verify = refreshing
+        # Refresh by hand: the patched clock would also wake the background loop
+        middleware.warm_refresh = False
+        monotonic = "aport_middleware.middleware.time.monotonic"
+        release = asyncio.Event()
+        
+        async def slow_verify(**kwargs):
+            await release.wait()
+            return verification_result()
+        
+        with patch(monotonic, return_value=1000.0):
+            await middleware.verify("policy.v1", "agt_1")
+            await middleware.verify("policy.v1", "agt_2")
+        verify.side_effect = slow_verify
+        with patch(monotonic, return_value=1020.0):
+            refresh = asyncio.ensure_future(middleware._refresh_expiring())
+            for _ in range(3):
+                await asyncio.sleep(0)
+            assert verify.call_count == 4
+            release.set()
+            await refresh
+    
+    async def test_failed_refresh_keeps_entry(self, refreshing):
+        """Test that a refresh error leaves the cached result in place."""
+        middleware, verify = refreshing
+        
+        with patch("aport_middleware.middleware.time.monotonic", return_value=1000.0):
+            result = await middleware.verify("policy.v1", "agt_1")
+        verify.side_effect = Exception("API Error")
+        with patch("aport_middleware.middleware.time.monotonic", return_value=1020.0):
+            await middleware._refresh_expiring()
+            assert await middleware.verify("policy.v1", "agt_1") is result
+
+
+class TestBatching:
+    """Test batching of concurrent verifications."""
+    
+    @pytest.fixture
+    def batching(self):
+        """Create a batching middleware with a mocked batch endpoint."""
+        middleware = APortMiddleware(api_key="test-key", cache_ttl=0, batch_window_ms=5)
+        with patch.object(middleware.client, "verify_batch", new_callable=AsyncMock) as verify_batch:
+            verify_batch.side_effect = lambda items: [
+                verification_result(passport={"agentId": agent_id}) for _, agent_id, _ in items
+            ]
+            yield middleware, verify_batch
+    
+    async def test_concurrent_verifications_share_a_batch(self, batching):
+        """Test that verifications within the window are sent together."""
+        middleware, verify_batch = batching
+        
+        results = await asyncio.gather(
+            middleware.verify("policy.v1", "agt_1"),
+            middleware.verify("policy.v2", "agt_2", {"a": 1}),
+        )
+        
+        verify_batch.assert_awaited_once_with([
+            ("policy.v1", "agt_1", None),
+            ("policy.v2", "agt_2", {"a": 1}),
+        ])
+        assert [result.passport["agentId"] for result in results] == ["agt_1", "agt_2"]
+    
+    async def test_batch_errors(self, batching):
+        """Test that a failed batch fails every caller and an item error only one."""
+        middleware, verify_batch = batching
+        
+        verify_batch.side_effect = Exception("API Error")
+        results = await asyncio.gather(
+            middleware.verify("policy.v1", "agt_1"),
+            middleware.verify("policy.v1", "agt_2"),
+            return_exceptions=True,
+        )
+        assert all(isinstance(result, APortError) for result in results)
+        assert results[0] is not results[1]
+        assert all(str(result.__cause__) == "API Error" for result in results)
+        
+        verify_batch.side_effect = None
+        verify_batch.return_value = [verification_result(), ValueError("bad agent")]
+        results = await asyncio.gather(
+            middleware.verify("policy.v1", "agt_1"),
+            middleware.verify("policy.v1", "agt_2"),
+            return_exceptions=True,
+        )
+        assert results[0].verified is True
+        assert isinstance(results[1], ValueError)
+    
+    async def test_cancelled_batch_releases_callers(self, batching):
+        """Test that callers are cancelled, not left waiting, if the batch call is."""
+        middleware, verify_batch = batching
+        verify_batch.side_effect = asyncio.CancelledError
+        
+        with pytest.raises(asyncio.CancelledError):
+            await asyncio.wait_for(middleware.verify("policy.v1", "agt_1"), timeout=1)
+    
+    async def test_aclose_closes_client_after_cancelled_batch(self, batching):
+        """Test that a cancelled batch does not stop aclose from closing the client."""
+        middleware, verify_batch = batching
+        middleware.batch_window = 60
+        verify_batch.side_effect = asyncio.CancelledError
+        client = middleware.client
+        
+        pending = asyncio.ensure_future(middleware.verify("policy.v1", "agt_1"))
+        await asyncio.sleep(0)
+        with patch.object(client, "aclose", new_callable=AsyncMock) as aclose:
+            await middleware.aclose()
+        
+        aclose.assert_awaited_once()
+        with pytest.raises(asyncio.CancelledError):
+            await pending
+    
+    async def test_aclose_flushes_pending_batch(self, batching):
+        """Test that aclose sends a batch still waiting for its window."""
+        middleware, verify_batch = batching
+        middleware.batch_window = 60
+        
+        pending = asyncio.ensure_future(middleware.verify("policy.v1", "agt_1"))
+        await asyncio.sleep(0)
+        await middleware.aclose()
+        
+        assert (await pending).passport["agentId"] == "agt_1"
+        verify_batch.assert_awaited_once()
+
+
+class TestClientLifecycle:
+    """Test creation and shutdown of the APort client."""
+    
+    async def test_aclose_closes_http_client(self):
+        """Test that aclose closes the HTTP client handed to the APort client."""
+        http_client = AsyncMock()
+        middleware = APortMiddleware(api_key="test-key", http_client=http_client)
+        
+        assert middleware.client.http_client is http_client
+        await middleware.aclose()
+        
+        http_client.aclose.assert_awaited_once()
+        assert "client" not in middleware.__dict__
+    
+    async def test_lifespan_shares_and_closes_client(self):
+        """Test that the lifespan handler exposes the client and closes it."""
+        http_client = AsyncMock()
+        middleware = APortMiddleware(api_key="test-key", http_client=http_client)
+        app = FastAPI(lifespan=middleware.lifespan)
+        
+        async with LifespanManager(app):
+            assert app.state.aport_client is middleware.client
+            http_client.aclose.assert_not_awaited()
+        
+        http_client.aclose.assert_awaited_once()
+    
+    async def test_aclose_without_client(self):
+        """Test that aclose does not create a client just to close it."""
+        middleware = APortMiddleware(api_key="test-key")
+        
+        await middleware.aclose()
+        
+        assert "client" not in middleware.__dict__
 
 
 class TestConvenienceFunction:
@@ -159,3 +775,193 @@ class TestConvenienceFunction:
         """Test that require_policy function works."""
         dependency = require_policy("test.policy")
         assert callable(dependency)
+    
+    async def test_aclose_shared_middleware(self):
+        """Test that shared middleware instances are closed and forgotten."""
+        require_policy("test.policy", api_key="closing-key")
+        shared = _shared_middleware[("closing-key", None)]
+        
+        with patch.object(shared, "aclose", new_callable=AsyncMock) as aclose:
+            await aclose_shared_middleware()
+        
+        aclose.assert_awaited_once()
+        assert _shared_middleware == {}
+    
+    def test_require_policy_shares_middleware(self):
+        """Test that dependencies with the same settings share a middleware."""
+        with patch.object(APortMiddleware, "require_policy", autospec=True) as create:
+            require_policy("test.policy", api_key="shared-key")
+            require_policy("other.policy", api_key="shared-key")
+            require_policy("test.policy", api_key="other-key")
+        
+        first, second, third = (call_args.args[0] for call_args in create.call_args_list)
+        assert first is second
+        assert first is not third
+
+
+@pytest.fixture(scope="module")
+def asgi_middleware():
+    """Create the APort middleware used by the ASGI test app."""
+    return APortMiddleware(api_key="test-key", cache_ttl=0)
+
+
+@pytest.fixture(scope="module")
+def asgi_app(asgi_middleware):
+    """Create an app protected by APortASGIMiddleware."""
+    app = FastAPI()
+    app.add_middleware(
+        APortASGIMiddleware,
+        policies={"/refund": "finance.payment.refund.v1", "/admin/public": "public.v1"},
+        prefix_policies={"/admin/": "admin.access", "/admin/reports/": "admin.reports"},
+        aport=asgi_middleware
+    )
+    
+    @app.get("/public")
+    async def public():
+        return {"message": "public"}
+    
+    @app.post("/refund")
+    async def refund(request: Request):
+        return {"success": True, "agent_id": request.state.aport["agent_id"]}
+    
+    @app.get("/admin/{page:path}")
+    async def admin(request: Request):
+        return {"policy": request.state.aport["policy"]}
+    
+    return app
+
+
+@pytest.fixture
+async def asgi_client(asgi_app):
+    """Create test client for the ASGI middleware app."""
+    async with serve(asgi_app) as client:
+        yield client
+
+
+@pytest.fixture
+def asgi_verify(asgi_middleware):
+    """Mock verify on the ASGI middleware's client."""
+    with patch.object(asgi_middleware.client, "verify", new_callable=AsyncMock) as verify:
+        yield verify
+
+
+class TestASGIMiddleware:
+    """Test the pure ASGI middleware."""
+    
+    async def test_unprotected_path_skips_verification(self, asgi_client, asgi_verify):
+        """Test that paths without a policy are passed through."""
+        response = await asgi_client.get("/public")
+        
+        assert response.status_code == 200
+        asgi_verify.assert_not_called()
+    
+    @pytest.mark.parametrize(
+        "path, policy",
+        [
+            ("/admin/users", "admin.access"),
+            ("/admin/reports/daily", "admin.reports"),
+            ("/admin/public", "public.v1"),
+        ]
+    )
+    async def test_policy_matching(self, asgi_client, asgi_verify, path, policy):
+        """Test exact paths win over prefixes and longer prefixes win."""
+        asgi_verify.return_value = verification_result()
+        
+        response = await asgi_client.get(path, headers={"X-Agent-ID": "agt_test123"})
+        
+        assert response.status_code == 200
+        assert asgi_verify.call_args.kwargs["policy"] == policy
+    
+    async def test_successful_verification(self, asgi_client, asgi_verify):
+        """Test that verified requests reach the route with request state set."""
+        asgi_verify.return_value = verification_result()
+        
+        response = await asgi_client.post("/refund", headers={"X-Agent-ID": "agt_test123"})
+        
+        assert response.status_code == 200
+        assert response.json()["agent_id"] == "agt_test123"
+        assert asgi_verify.call_args.kwargs["policy"] == "finance.payment.refund.v1"
+    
+    async def test_agent_id_from_query(self, asgi_client, asgi_verify):
+        """Test agent ID extraction from the query string."""
+        asgi_verify.return_value = verification_result()
+        
+        response = await asgi_client.post("/refund?agent_id=agt_query123")
+        
+        assert response.status_code == 200
+        assert response.json()["agent_id"] == "agt_query123"
+    
+    async def test_missing_agent_id(self, asgi_client, asgi_verify):
+        """Test request without agent ID."""
+        response = await asgi_client.post("/refund")
+        
+        assert response.status_code == 400
+        assert response.json()["detail"]["error"] == "Agent ID required"
+        asgi_verify.assert_not_called()
+    
+    async def test_failed_verification(self, asgi_client, asgi_verify):
+        """Test failed agent verification."""
+        asgi_verify.return_value = verification_result(
+            verified=False,
+            message="Agent not authorized"
+        )
+        
+        response = await asgi_client.post("/refund", headers={"X-Agent-ID": "agt_unauthorized"})
+        
+        assert response.status_code == 403
+        assert response.json()["detail"]["message"] == "Agent not authorized"
+    
+    async def test_verification_error(self, asgi_client, asgi_verify):
+        """Test verification API error."""
+        asgi_verify.side_effect = Exception("API Error")
+        
+        response = await asgi_client.post("/refund", headers={"X-Agent-ID": "agt_test123"})
+        
+        assert response.status_code == 500
+        assert response.json()["detail"]["error"] == "Verification error"
+
+
+class TestTimingMiddleware:
+    """Test the Server-Timing middleware."""
+    
+    @pytest.fixture
+    async def timing_client(self, middleware):
+        """Create an app with a protected route wrapped in the timing middleware."""
+        app = FastAPI()
+        app.add_middleware(APortTimingMiddleware)
+        dependency = middleware.require_policy("finance.payment.refund.v1")
+        
+        @app.get("/public")
+        async def public():
+            return {"message": "public"}
+        
+        @app.post("/refund")
+        async def refund(aport_data: dict = Depends(dependency)):
+            return {"agent_id": aport_data["agent_id"]}
+        
+        async with serve(app) as client:
+            yield client
+    
+    async def test_verify_and_total_durations(self, timing_client, mock_verify):
+        """Test that verification time is reported next to the total."""
+        mock_verify.return_value = verification_result()
+        
+        response = await timing_client.post("/refund", headers={"X-Agent-ID": "agt_test123"})
+        
+        assert response.status_code == 200
+        assert re.fullmatch(r"verify;dur=\d+\.\d{2}, total;dur=\d+\.\d{2}", response.headers["server-timing"])
+    
+    async def test_failed_verification_is_timed(self, timing_client, mock_verify):
+        """Test that rejected requests still report verification time."""
+        mock_verify.side_effect = Exception("API Error")
+        
+        response = await timing_client.post("/refund", headers={"X-Agent-ID": "agt_test123"})
+        
+        assert response.status_code == 500
+        assert response.headers["server-timing"].startswith("verify;dur=")
+    
+    async def test_unprotected_route_reports_total_only(self, timing_client):
+        """Test that routes without verification only report the total."""
+        response = await timing_client.get("/public")
+        
+        assert re.fullmatch(r"total;dur=\d+\.\d{2}", response.headers["server-timing"])